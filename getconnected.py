@@ -1,91 +1,255 @@
 import csv
 import os
-import re
+import queue
+import asyncio
 import logging
 import argparse
+import functools
+import operator
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import NewType
 from meraki.sdk_client import DashboardAPI
 
 # Setup logging
-logging.basicConfig(filename='device_lookup.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logging.basicConfig(filename='device_lookup.log', level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', encoding='utf-8')
 
 # Parse command line arguments
 parser = argparse.ArgumentParser(description="Fetch device details from Meraki API including VLAN and data usage.")
-parser.add_argument("-f", "--file", help="Path to file containing MAC addresses, one per line.", default="mac_addresses.txt")
-parser.add_argument("-m", "--mac", help="A single MAC address to lookup.")
+input_group = parser.add_mutually_exclusive_group(required=True)
+input_group.add_argument("-f", "--file", help="Path to file containing MAC addresses, one per line.")
+input_group.add_argument("-m", "--mac", help="A single MAC address to lookup.")
 args = parser.parse_args()
 
 # Configuration Variables
 API_KEY = os.getenv("MERAKI_API_KEY")  # It's recommended to use an environment variable for API keys
 NETWORK_ID = 'your_network_id_here'  # Replace with your actual Network ID
 CSV_FILE = "device_info.csv"  # Output CSV file name
+CSV_COLUMNS = {  # Output CSV column name -> DeviceRow attribute
+    "MAC Address": "mac_address",
+    "Description": "description",
+    "VLAN": "vlan",
+    "Usage": "usage",
+}
+FIELDNAMES = tuple(CSV_COLUMNS)  # Default output CSV columns
+CONCURRENCY = 20  # Maximum number of API calls in flight at once
+REQUESTS_PER_SECOND = 10  # Meraki's per-organization API rate limit
+MAX_RETRIES = 3  # Retries for a lookup that was rate limited (HTTP 429)
+WRITE_QUEUE_SIZE = 1000  # Rows buffered between the lookups and the CSV writer thread
+WRITE_POLL_INTERVAL = 0.5  # Seconds between checks that the CSV writer is still running while its queue is full
+CLIENT_TIMESPAN = 86400  # Seconds of history covered by the bulk network client listing
+BULK_LOOKUP_MIN_MACS = 50  # Fewest MACs worth listing the whole network for instead of looking each one up
+
+_HEX_DIGITS = frozenset('0123456789abcdefABCDEF')
+_SEPARATORS = frozenset(':-')
+_SEPARATOR_POSITIONS = (2, 5, 8, 11, 14)
+_HEX_POSITIONS = tuple(i for i in range(17) if i not in _SEPARATOR_POSITIONS)
 
 # Initialize the Meraki dashboard API
 dashboard = DashboardAPI(api_key=API_KEY)
 
+# A MAC address that has passed validate_mac_address and been normalized; only parse_mac_address creates one
+ValidMac = NewType("ValidMac", str)
+
+@dataclass(slots=True)
+class DeviceRow:
+    """One device's details; CSV_COLUMNS maps output columns onto these fields."""
+    mac_address: str
+    description: str | None = None
+    vlan: int | None = None
+    usage: int | str = "N/A"
+
 def validate_mac_address(mac):
-    """Validate the MAC address format."""
-    pattern = re.compile(r'^([0-9A-Fa-f]{2}[:-]){5}([0-9A-Fa-f]{2})$')
-    return bool(pattern.match(mac))
+    """Validate the MAC address format (six hex pairs separated by ':' or '-')."""
+    if len(mac) != 17:
+        return False
+    return (all(mac[i] in _SEPARATORS for i in _SEPARATOR_POSITIONS)
+            and all(mac[i] in _HEX_DIGITS for i in _HEX_POSITIONS))
 
-def read_mac_addresses(file_path):
-    """Read and validate MAC addresses from a file, returning them as a list."""
+def parse_mac_address(mac: str) -> ValidMac | None:
+    """Validate a MAC address and return it in the lowercase, colon-separated form the Meraki API uses, or None."""
+    if not validate_mac_address(mac):
+        return None
+    return ValidMac(mac.lower().replace("-", ":"))
+
+def read_mac_addresses(file_path) -> list[ValidMac]:
+    """Read, validate and normalize MAC addresses from a file, returning them as a list."""
     try:
         with open(file_path, "r") as file:
-            macs = [line.strip() for line in file.readlines() if line.strip()]
-            return [mac for mac in macs if validate_mac_address(mac)]
+            macs = (parse_mac_address(line.strip()) for line in file)
+            return [mac for mac in macs if mac is not None]
     except FileNotFoundError:
-        logging.error(f"File {file_path} not found.")
+        logging.error("File %s not found.", file_path)
         return []
     except Exception as e:
-        logging.error(f"Unexpected error reading file {file_path}: {e}")
+        logging.error("Unexpected error reading file %s: %s", file_path, e)
         return []
 
-def fetch_client_details(network_id, mac_address):
-    """Fetch client details by MAC address using the Meraki SDK."""
+def retry_after(error):
+    """Return the delay in seconds requested by a rate limited (HTTP 429) API error, or None."""
+    if getattr(error, "status", None) != 429:
+        return None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
     try:
-        client = dashboard.networks.get_network_client(network_id=network_id, client_id=mac_address, include_usage=True)
-        return client
+        return float(headers.get("Retry-After", 1))
+    except (TypeError, ValueError):
+        return 1.0
+
+class RequestPacer:
+    """Space API calls evenly so they stay at, but not above, a fixed rate."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.next_slot = 0.0
+
+    async def wait(self):
+        """Sleep until the next free slot; slots are claimed in call order."""
+        now = asyncio.get_running_loop().time()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        await asyncio.sleep(slot - now)
+
+async def fetch_client_details(network_id, mac_address, semaphore, pacer, executor):
+    """Fetch client details by MAC address using the Meraki SDK on executor, retrying when rate limited."""
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        for attempt in range(MAX_RETRIES + 1):
+            await pacer.wait()
+            try:
+                return await loop.run_in_executor(executor, functools.partial(
+                    dashboard.networks.get_network_client,
+                    network_id=network_id, client_id=mac_address, include_usage=True))
+            except Exception as e:
+                delay = retry_after(e)
+                if delay is not None and attempt < MAX_RETRIES:
+                    await asyncio.sleep(delay)
+                    continue
+                logging.error("Error fetching details for MAC %s: %s", mac_address, e)
+                return None
+
+def fetch_network_clients(network_id):
+    """Fetch every client seen on the network within CLIENT_TIMESPAN, keyed by lowercase MAC address (unpaced paged calls)."""
+    # The SDK pages through the listing itself, so these calls bypass RequestPacer
+    try:
+        clients = dashboard.networks.get_network_clients(
+            network_id=network_id, timespan=CLIENT_TIMESPAN, per_page=1000, total_pages="all")
     except Exception as e:
-        logging.error(f"Error fetching details for MAC {mac_address}: {e}")
-        return None
+        logging.error("Error fetching clients for network %s: %s", network_id, e)
+        return {}
+    return {client["mac"].lower(): client for client in clients if client.get("mac")}
 
-def write_to_csv(file_path, data):
-    """Write device information to a CSV file."""
-    with open(file_path, "w", newline="") as file:
-        writer = csv.DictWriter(file, fieldnames=data[0].keys())
-        writer.writeheader()
-        writer.writerows(data)
-    logging.info(f"Device information successfully written to {file_path}.")
-
-def process_mac_addresses(network_id, mac_addresses):
-    """Process a list of MAC addresses to fetch and log device details."""
-    device_info_list = []
+def write_to_csv(writer, row_queue, fieldnames=FIELDNAMES):
+    """Write the fieldnames columns of DeviceRows from a queue with a csv.writer until a None sentinel is received."""
+    row_values = operator.attrgetter(*(CSV_COLUMNS[name] for name in fieldnames))
+    single_column = len(fieldnames) == 1  # attrgetter returns a bare value, not a tuple, for one attribute
+    count = 0
+    for row in iter(row_queue.get, None):
+        values = row_values(row)
+        writer.writerow((values,) if single_column else values)
+        count += 1
+    return count
+
+def queue_row(row_queue, writer_future, row):
+    """Put a row on the CSV writer's queue, raising the writer's error instead of blocking if it has stopped."""
+    while True:
+        try:
+            row_queue.put(row, timeout=WRITE_POLL_INTERVAL)
+            return
+        except queue.Full:
+            if writer_future.done():
+                writer_future.result()
+                raise RuntimeError("CSV writer stopped before all rows were written.")
+
+def build_device_info(mac, client_details):
+    """Build the CSV row for a MAC address from its client details."""
+    # Simplified data structure; extend as needed based on available client details
+    return DeviceRow(
+        mac_address=mac,
+        description=client_details.get("description"),
+        vlan=client_details.get("vlan"),
+        usage=client_details.get("usage", {}).get("total", "N/A")
+    )
+
+async def process_mac_addresses(network_id, mac_addresses: list[ValidMac], executor):
+    """Process a list of validated MAC addresses concurrently, yielding device details as each lookup completes."""
+    # The SDK is blocking, so every API call runs on a thread from the caller-owned executor
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    pacer = RequestPacer(REQUESTS_PER_SECOND)
+
+    # For a large enough batch, one paged listing of the network replaces a call per MAC
+    if len(mac_addresses) >= BULK_LOOKUP_MIN_MACS:
+        known_clients = await loop.run_in_executor(executor, fetch_network_clients, network_id)
+    else:
+        known_clients = {}
+    misses = []
     for mac in mac_addresses:
-        client_details = fetch_client_details(network_id, mac)
+        client_details = known_clients.get(mac)
         if client_details:
-            # Simplified data structure; extend as needed based on available client details
-            device_info = {
-                "MAC Address": mac,
-                "Description": client_details.get("description"),
-                "VLAN": client_details.get("vlan"),
-                "Usage": client_details.get("usage", {}).get("total", "N/A")
-            }
-            device_info_list.append(device_info)
-    return device_info_list
+            yield build_device_info(mac, client_details)
+        else:
+            misses.append(mac)
+
+    async def lookup(mac):
+        return mac, await fetch_client_details(network_id, mac, semaphore, pacer, executor)
+
+    for next_result in asyncio.as_completed([lookup(mac) for mac in misses]):
+        mac, client_details = await next_result
+        if client_details:
+            yield build_device_info(mac, client_details)
+
+async def queue_device_info(network_id, mac_addresses: list[ValidMac], row_queue, writer_future, executor, write_executor):
+    """Feed device details into the CSV writer's queue as lookups complete."""
+    loop = asyncio.get_running_loop()
+    async for row in process_mac_addresses(network_id, mac_addresses, executor):
+        try:
+            row_queue.put_nowait(row)
+        except queue.Full:
+            # Wait for room off the event loop so lookups keep running in the meantime. queue_row polls every
+            # WRITE_POLL_INTERVAL and holds its write_executor thread for as long as the writer is behind.
+            await loop.run_in_executor(write_executor, queue_row, row_queue, writer_future, row)
+
+def export_device_info(network_id, mac_addresses: list[ValidMac], file, fieldnames=FIELDNAMES):
+    """Look up device details and write them as CSV to an open file on a background thread, returning the row count."""
+    csv_writer = csv.writer(file)
+    csv_writer.writerow(fieldnames)
+    row_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+    # Size the lookup pool to match the semaphore in process_mac_addresses. The write pool holds the writer
+    # plus the one producer that can be waiting for room in its queue at a time.
+    with ThreadPoolExecutor(max_workers=CONCURRENCY) as executor, ThreadPoolExecutor(max_workers=2) as write_executor:
+        writer_future = write_executor.submit(write_to_csv, csv_writer, row_queue, fieldnames)
+        try:
+            asyncio.run(queue_device_info(network_id, mac_addresses, row_queue, writer_future, executor, write_executor))
+        finally:
+            if not writer_future.done():
+                queue_row(row_queue, writer_future, None)
+        # Re-raises any error from the writer thread
+        return writer_future.result()
 
 def main():
-    if args.mac and validate_mac_address(args.mac):
-        mac_addresses = [args.mac]
-    elif args.file:
-        mac_addresses = read_mac_addresses(args.file)
+    if args.mac is not None:
+        mac = parse_mac_address(args.mac)
+        if mac is None:
+            logging.error("Invalid MAC address %s.", args.mac)
+            return
+        mac_addresses = [mac]
     else:
-        logging.error("No valid input provided. Please specify a MAC address or a file with MAC addresses.")
-        return
+        # A missing file is reported by read_mac_addresses when open() fails
+        mac_addresses = read_mac_addresses(args.file)
+        unique_macs = list(dict.fromkeys(mac_addresses))
+        if len(unique_macs) < len(mac_addresses):
+            logging.info("%d duplicate MAC addresses removed.", len(mac_addresses) - len(unique_macs))
+        mac_addresses = unique_macs
 
     if mac_addresses:
-        device_info = process_mac_addresses(NETWORK_ID, mac_addresses)
-        if device_info:
-            write_to_csv(CSV_FILE, device_info)
+        try:
+            with open(CSV_FILE, "w", newline="", buffering=1 << 16) as file:
+                count = export_device_info(NETWORK_ID, mac_addresses, file)
+        except Exception as e:
+            logging.error("Error exporting device information to %s: %s", CSV_FILE, e)
+            raise
+        if count:
+            logging.info("%d device records written to %s.", count, CSV_FILE)
         else:
             logging.info("No device information found for the provided MAC addresses.")
     else: